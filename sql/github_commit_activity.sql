@@ -0,0 +1,25 @@
+-- Raw weekly commit buckets from the GitHub stats/commit_activity endpoint.
+-- The ETL appends a snapshot per run (same additive model as the other
+-- staging tables); the aggregates live here so Snowflake is the single
+-- aggregation engine rather than pre-summing in Python.
+
+CREATE TABLE IF NOT EXISTS github_commit_activity_weekly (
+    name STRING,
+    week_start DATE,
+    total NUMBER,
+    collected_at TIMESTAMP_NTZ
+);
+
+CREATE OR REPLACE VIEW github_commit_activity_agg AS
+WITH latest AS (
+    SELECT *
+    FROM github_commit_activity_weekly
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY name, week_start ORDER BY collected_at DESC) = 1
+)
+SELECT
+    name,
+    SUM(CASE WHEN week_start >= DATEADD(year, -1, CURRENT_DATE()) THEN total END) AS commits_last_year,
+    -- four weeks to stay consistent with the PyPI "last month" window
+    SUM(CASE WHEN week_start >= DATEADD(week, -4, CURRENT_DATE()) THEN total END) AS commits_last_month
+FROM latest
+GROUP BY name;
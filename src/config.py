@@ -0,0 +1,82 @@
+"""
+Shared configuration loading
+Parses config.json and the environment once so the phase modules don't
+each re-read and re-validate the same things per run
+"""
+
+import json
+import os
+from dataclasses import dataclass
+from dotenv import load_dotenv
+
+SNOWFLAKE_ENV_VARS = (
+    'SNOWFLAKE_USER', 'SNOWFLAKE_PASSWORD', 'SNOWFLAKE_ACCOUNT',
+    'SNOWFLAKE_WAREHOUSE', 'SNOWFLAKE_DATABASE', 'SNOWFLAKE_SCHEMA'
+)
+
+class ConfigError(Exception):
+    """Raised when config.json or required environment variables are missing.
+
+    Raised (rather than exit(1)) so the orchestrator can log the problem and
+    decide what to do without the whole process being killed mid-run.
+    """
+
+@dataclass(frozen=True)
+class Config:
+    github_token: str
+    gcp_project: str
+    gcp_credentials: str
+    libraries: tuple
+    snowflake: dict
+    # Optional: set both to route full PyPI loads BigQuery -> GCS -> COPY
+    # without materializing locally (stage setup is a one-off, see README)
+    gcs_uri: str = None
+    gcs_stage: str = None
+
+def load_config():
+    """Load configuration from config.json file and environment variables"""
+    # Load environment variables
+    load_dotenv()
+
+    # Load libraries from config file
+    try:
+        with open('config.json', 'r') as f:
+            config_data = json.load(f)
+    except FileNotFoundError:
+        raise ConfigError("config.json not found")
+
+    # Get credentials from environment variables
+    config = Config(
+        github_token=os.getenv('GITHUB_TOKEN'),
+        gcp_project=os.getenv('GOOGLE_CLOUD_PROJECT'),
+        gcp_credentials=os.getenv('GOOGLE_APPLICATION_CREDENTIALS'),
+        libraries=tuple(config_data.get('libraries', [])),
+        snowflake={
+            "user": os.getenv('SNOWFLAKE_USER'),
+            "password": os.getenv('SNOWFLAKE_PASSWORD'),
+            "account": os.getenv('SNOWFLAKE_ACCOUNT'),
+            "warehouse": os.getenv('SNOWFLAKE_WAREHOUSE'),
+            "database": os.getenv('SNOWFLAKE_DATABASE'),
+            "schema": os.getenv('SNOWFLAKE_SCHEMA')
+        },
+        gcs_uri=os.getenv('PYPI_GCS_URI'),
+        gcs_stage=os.getenv('SNOWFLAKE_GCS_STAGE')
+    )
+
+    # Validate required environment variables
+    if not config.github_token:
+        raise ConfigError("GITHUB_TOKEN not found in environment variables")
+
+    if not config.gcp_project:
+        raise ConfigError("GOOGLE_CLOUD_PROJECT not found in environment variables")
+
+    if not config.gcp_credentials:
+        raise ConfigError("GOOGLE_APPLICATION_CREDENTIALS not found in environment variables")
+
+    if not all(config.snowflake.values()):
+        raise ConfigError(
+            "Missing Snowflake environment variables. Required: "
+            + ", ".join(SNOWFLAKE_ENV_VARS)
+        )
+
+    return config
@@ -1,121 +1,267 @@
-import requests
+import asyncio
+import aiohttp
 import json
+import orjson
+import time
+import pandas as pd
 import snowflake.connector
-from datetime import datetime
-import os
-from dotenv import load_dotenv
-
-def load_config():
-    """Load configuration from config.json file and environment variables"""
-    # Load environment variables
-    load_dotenv()
-    
-    # Load libraries from config file
+from snowflake.connector.pandas_tools import write_pandas
+from datetime import datetime, timedelta, timezone
+
+from config import load_config
+
+ETAG_CACHE_PATH = 'etag_cache.json'
+
+def load_etag_cache():
+    """Load the {url: {etag, body}} sidecar cache from the previous run"""
     try:
-        with open('config.json', 'r') as f:
-            config_data = json.load(f)
-    except FileNotFoundError:
-        print("Error: config.json not found")
-        exit(1)
-    
-    # Get credentials from environment variables
-    config = {
-        "github_token": os.getenv('GITHUB_TOKEN'),
-        "libraries": config_data.get('libraries', []),
-        "snowflake": {
-            "user": os.getenv('SNOWFLAKE_USER'),
-            "password": os.getenv('SNOWFLAKE_PASSWORD'),
-            "account": os.getenv('SNOWFLAKE_ACCOUNT'),
-            "warehouse": os.getenv('SNOWFLAKE_WAREHOUSE'),
-            "database": os.getenv('SNOWFLAKE_DATABASE'),
-            "schema": os.getenv('SNOWFLAKE_SCHEMA')
-        }
-    }
-    
-    # Validate required environment variables
-    if not config['github_token']:
-        print("Error: GITHUB_TOKEN not found in environment variables")
-        exit(1)
-    
-    if not all(config['snowflake'].values()):
-        print("Error: Missing Snowflake environment variables. Required:")
-        print("SNOWFLAKE_USER, SNOWFLAKE_PASSWORD, SNOWFLAKE_ACCOUNT, SNOWFLAKE_WAREHOUSE, SNOWFLAKE_DATABASE, SNOWFLAKE_SCHEMA")
-        exit(1)
-    
-    return config
-
-def get_repo_metrics(library_name, owner, repo, github_token):
-    
-    # Should probably be refactored given constant call and response
-
-    headers = {'Authorization': f'token {github_token}'}
-    url = f"https://api.github.com/repos/{owner}/{repo}"
-    
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        print(f"Error fetching {owner}/{repo}: {response.status_code}")
-        return None
-    
-    data = response.json()
-    
-    # Basic metrics get initialised
-    metrics = {
-        'library_name': library_name,
-        'owner': owner,
-        'repo_name': repo,
-        'stars': data.get('stargazers_count', 0),
-        'forks': data.get('forks_count', 0),
-        'watchers': data.get('watchers_count', 0),
-        'open_issues': data.get('open_issues_count', 0),
-        'language': data.get('language'),
-        'size_kb': data.get('size', 0),
-        'created_at': data.get('created_at'),
-        'updated_at': data.get('updated_at'),
-        'collected_at': datetime.now().isoformat()
-    }
+        with open(ETAG_CACHE_PATH, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_etag_cache(cache):
+    with open(ETAG_CACHE_PATH, 'w') as f:
+        json.dump(cache, f)
+
+class RateLimitError(Exception):
+    """Raised when the GitHub API quota is exhausted and won't recover soon"""
+    def __init__(self, reset_at):
+        super().__init__(f"GitHub rate limit exhausted, resets at {reset_at}")
+        self.reset_at = reset_at
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+async def gh_request(session, method, url, json_body=None, etag_cache=None, max_retries=5):
+    """Issue a GitHub API request while honouring the rate-limit headers.
+
+    Returns (status, body). When the remaining quota runs low we sleep until
+    X-RateLimit-Reset rather than burning rejected requests (403/429s still
+    count against the quota), and transient 429/5xx responses are retried
+    with exponential backoff. A hard 403/429 with zero quota left raises
+    RateLimitError so the caller can back off the whole pool.
+
+    When an etag_cache dict is supplied the request goes out conditional
+    (If-None-Match); a 304 reuses the cached body and doesn't count against
+    the rate limit at all.
+    """
+    cached = (etag_cache or {}).get(url)
+    headers = {'If-None-Match': cached['etag']} if cached else {}
+
+    status = None
+    for attempt in range(max_retries):
+        async with session.request(method, url, json=json_body, headers=headers) as response:
+            status = response.status
+            remaining = int(response.headers.get('X-RateLimit-Remaining', 1))
+            reset_at = int(response.headers.get('X-RateLimit-Reset', 0))
+
+            if status in (403, 429) and remaining == 0:
+                if attempt < max_retries - 1:
+                    # Quota gone; wait out the window then retry
+                    wait = max(0, reset_at - time.time())
+                    print(f"    Rate limit hit, sleeping {wait:.0f}s until reset...")
+                    await asyncio.sleep(wait)
+                    continue
+                raise RateLimitError(reset_at)
+
+            if status in RETRYABLE_STATUSES and attempt < max_retries - 1:
+                # Transient server-side hiccup; back off exponentially
+                await asyncio.sleep(2 ** attempt)
+                continue
 
-    # Contributor Stats
-    print(f"Fetching contributor stats...")
-    url = f"https://api.github.com/repos/{owner}/{repo}/stats/contributors"
-    response = requests.get(url, headers=headers)
+            if status == 304 and cached:
+                # Unchanged since last run; the 304 was free quota-wise
+                return 200, cached['body']
+
+            # orjson is a fair bit faster than stdlib json on the chunky
+            # GitHub payloads, which matters now that parsing isn't hidden
+            # behind serial network waits
+            body = orjson.loads(await response.read()) if status == 200 else None
+
+            if status == 200 and etag_cache is not None and response.headers.get('ETag'):
+                etag_cache[url] = {'etag': response.headers['ETag'], 'body': body}
+
+            if remaining < 5:
+                # Low-water mark: pause here so the pool drains gracefully
+                # instead of stampeding into the limit
+                wait = max(0, reset_at - time.time())
+                print(f"    Rate limit nearly exhausted, sleeping {wait:.0f}s...")
+                await asyncio.sleep(wait)
+
+            return status, body
+
+    return status, None
+
+async def gh_get(session, url, etag_cache=None, max_retries=5):
+    return await gh_request(session, 'GET', url, etag_cache=etag_cache,
+                            max_retries=max_retries)
+
+async def gh_post(session, url, json_body, max_retries=5):
+    # POSTs (GraphQL) aren't ETag-cacheable but share the same retry,
+    # backoff, and rate-limit handling
+    return await gh_request(session, 'POST', url, json_body=json_body,
+                            max_retries=max_retries)
+
+GRAPHQL_URL = "https://api.github.com/graphql"
+GRAPHQL_BATCH_SIZE = 50
+
+def build_metrics_query(batch):
+    """Build one aliased GraphQL document covering a batch of repositories"""
+    # UTC, since the bounds are serialized with a Z suffix -- naive local
+    # time would shift the history windows by the host's UTC offset
+    now = datetime.now(timezone.utc)
+    since_year = (now - timedelta(weeks=52)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    # four weeks to match the PyPI "last month" window
+    since_month = (now - timedelta(weeks=4)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    parts = []
+    for i, library in enumerate(batch):
+        parts.append(f"""
+        r{i}: repository(owner: "{library['github_owner']}", name: "{library['github_repo']}") {{
+            stargazerCount
+            forkCount
+            watchers {{ totalCount }}
+            issues(states: OPEN) {{ totalCount }}
+            primaryLanguage {{ name }}
+            diskUsage
+            createdAt
+            updatedAt
+            defaultBranchRef {{
+                target {{
+                    ... on Commit {{
+                        total: history {{ totalCount }}
+                        lastYear: history(since: "{since_year}") {{ totalCount }}
+                        lastMonth: history(since: "{since_month}") {{ totalCount }}
+                    }}
+                }}
+            }}
+        }}""")
+
+    return "query {" + "".join(parts) + "\n}"
+
+async def fetch_repo_metrics(session, libraries):
+    """Fetch repository metrics for all libraries via GraphQL.
+
+    One POST covers up to GRAPHQL_BATCH_SIZE repositories using aliases, so
+    the whole library list costs one or two API calls rather than several
+    REST calls per repo. Commit counts come from defaultBranchRef history
+    with since-dates instead of the REST commit_activity weekly buckets.
+    """
+    all_metrics = []
 
-    if response.status_code != 200:
-        print(f"    Error fetching contributor stats: {response.status_code}")
+    for start in range(0, len(libraries), GRAPHQL_BATCH_SIZE):
+        batch = libraries[start:start + GRAPHQL_BATCH_SIZE]
+        query = build_metrics_query(batch)
+
+        status, payload = await gh_post(session, GRAPHQL_URL, {'query': query})
+        if status != 200 or payload is None:
+            print(f"Error on GraphQL batch starting at {start}: {status}")
+            continue
+
+        data = payload.get('data') or {}
+        for i, library in enumerate(batch):
+            repo = data.get(f'r{i}')
+            if not repo:
+                print(f"Error fetching {library['github_owner']}/{library['github_repo']} via GraphQL")
+                continue
+
+            history = (repo.get('defaultBranchRef') or {}).get('target') or {}
+            metrics = {
+                'library_name': library['name'],
+                'owner': library['github_owner'],
+                'repo_name': library['github_repo'],
+                'stars': repo.get('stargazerCount', 0),
+                'forks': repo.get('forkCount', 0),
+                'watchers': (repo.get('watchers') or {}).get('totalCount', 0),
+                'open_issues': (repo.get('issues') or {}).get('totalCount', 0),
+                'language': (repo.get('primaryLanguage') or {}).get('name'),
+                'size_kb': repo.get('diskUsage', 0),
+                'created_at': repo.get('createdAt'),
+                'updated_at': repo.get('updatedAt'),
+                'collected_at': datetime.now().isoformat(),
+                'total_commits': (history.get('total') or {}).get('totalCount'),
+                'commits_last_year': (history.get('lastYear') or {}).get('totalCount'),
+                'commits_last_month': (history.get('lastMonth') or {}).get('totalCount')
+            }
+            all_metrics.append(metrics)
+            print(f"{library['github_owner']}/{library['github_repo']} finished!")
+
+    return all_metrics
+
+async def fetch_contributor_count(metrics, session, sem, etag_cache):
+    # GraphQL has no contributor-count field, so this one still comes from
+    # the REST stats endpoint
+    url = f"https://api.github.com/repos/{metrics['owner']}/{metrics['repo_name']}/stats/contributors"
+
+    async with sem:
+        status, contributors = await gh_get(session, url, etag_cache)
+
+    if status != 200:
+        print(f"    Error fetching contributor stats for {metrics['owner']}/{metrics['repo_name']}: {status}")
         metrics['total_contributors'] = None
-        metrics['total_commits'] = None
-    else: 
-        contributors = response.json()
+    else:
         metrics['total_contributors'] = len(contributors)
-        metrics['total_commits'] = sum(contrib.get('total', 0) for contrib in contributors)
-
-    # Commit Activity Stats
-    print(f"Fetching granular commit activity stats...")
-    url = f"https://api.github.com/repos/{owner}/{repo}/stats/commit_activity"
-    response = requests.get(url, headers=headers)
-
-    if response.status_code != 200:
-        print(f"    Error fetching commit activity stats: {response.status_code}")
-        metrics['commits_last_year'] = None
-        metrics['commits_last_month'] = None
-    else: 
-        commit_activity = response.json()
-        metrics['commits_last_year'] = sum(week.get('total', 0) for week in commit_activity)
-        # Get recent activity (last 4 weeks)
-        recent_weeks = commit_activity[-4:] if len(commit_activity) >= 4 else commit_activity
-        metrics['commits_last_month'] = sum(week.get('total', 0) for week in recent_weeks)
-
-    # Finished!
-    print(f"{owner}/{repo} finished!")
-    return metrics
-
-def insert_metrics(metrics_list, snowflake_config):
+
+async def fetch_commit_activity(metrics, session, sem, etag_cache):
+    # Raw weekly buckets for the higher-fidelity commit-activity table;
+    # the last-year/last-month aggregates are computed in Snowflake
+    # (sql/github_commit_activity.sql) rather than pre-summed in Python
+    url = f"https://api.github.com/repos/{metrics['owner']}/{metrics['repo_name']}/stats/commit_activity"
+
+    async with sem:
+        status, weeks = await gh_get(session, url, etag_cache)
+
+    if status != 200:
+        print(f"    Error fetching commit activity for {metrics['owner']}/{metrics['repo_name']}: {status}")
+        return []
+
+    return [
+        {
+            'name': metrics['library_name'],
+            'week_start': datetime.fromtimestamp(week['week'], timezone.utc).date(),
+            'total': week.get('total', 0),
+            'collected_at': metrics['collected_at']
+        }
+        for week in weeks
+    ]
+
+def insert_commit_activity(activity_rows, conn):
+    # Appends the raw weekly buckets as a snapshot; no pre-aggregation here
+    if not activity_rows:
+        print("No commit activity to insert")
+        return
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS github_commit_activity_weekly (
+            name STRING,
+            week_start DATE,
+            total NUMBER,
+            collected_at TIMESTAMP_NTZ
+        )
+        """)
+    finally:
+        cursor.close()
+
+    df = pd.DataFrame(activity_rows).rename(columns=str.upper)
+    success, nchunks, nrows, _ = write_pandas(
+        conn,
+        df,
+        table_name='GITHUB_COMMIT_ACTIVITY_WEEKLY',
+        quote_identifiers=False,
+        compression='snappy',
+        parallel=4
+    )
+    print(f"Inserted {nrows} weekly commit-activity rows into Snowflake (success={success})")
+
+def insert_metrics(metrics_list, conn):
     # Inserts metrics into the pre-built Snowflake DB
 
     if not metrics_list:
         print("No metrics to insert")
         return
 
-    conn = snowflake.connector.connect(**snowflake_config)
     cursor = conn.cursor()
 
     sql = """
@@ -126,55 +272,85 @@ def insert_metrics(metrics_list, snowflake_config):
     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
     """
 
-    for metrics in metrics_list:
-        cursor.execute(sql, (
-            metrics['library_name'],
-            metrics['owner'],
-            metrics['repo_name'],
-            metrics['stars'],
-            metrics['forks'],
-            metrics['watchers'],
-            metrics['open_issues'],
-            metrics['language'],
-            metrics['size_kb'],
-            metrics['created_at'],
-            metrics['updated_at'],
-            metrics['collected_at'],
-            metrics['total_contributors'],
-            metrics['total_commits'],
-            metrics['commits_last_year'],
-            metrics['commits_last_month']
-        ))
-    
+    cols = ('library_name', 'owner', 'repo_name', 'stars', 'forks', 'watchers',
+            'open_issues', 'language', 'size_kb', 'created_at', 'updated_at',
+            'collected_at', 'total_contributors', 'total_commits',
+            'commits_last_year', 'commits_last_month')
+
+    # executemany lets the connector rewrite this into a bulk load, so it's
+    # one round-trip instead of one per library. Chunked because Snowflake
+    # caps the number of bound parameters per statement.
+    params = [tuple(metrics[col] for col in cols) for metrics in metrics_list]
+    chunk_size = 16000
+    for start in range(0, len(params), chunk_size):
+        cursor.executemany(sql, params[start:start + chunk_size])
+
     conn.commit()
     cursor.close()
-    conn.close()
     print(f"Inserted {len(metrics_list)} records into Snowflake")
 
-def main():
-    # Load configuration
-    config = load_config()
-    
-    # Collect metrics for all libraries
-    all_metrics = []
+async def main(conn=None, config=None):
+    # The orchestrator passes the parsed config in; standalone runs load it
+    if config is None:
+        config = load_config()
 
+    # The orchestrator passes in a shared connection so the Snowflake
+    # handshake isn't paid once per phase; standalone runs open their own
+    owns_conn = conn is None
+    if owns_conn:
+        conn = snowflake.connector.connect(**config.snowflake)
 
-    for library in config['libraries']:
-        print(f"Fetching metrics for {library['name']} ({library['github_owner']}/{library['github_repo']})...")
+    # Batched GraphQL covers the repo-level metrics; the remaining REST
+    # calls fan out concurrently behind a semaphore to stay under GitHub's
+    # secondary rate limit
+    sem = asyncio.Semaphore(10)
+    headers = {
+        'Authorization': f"token {config.github_token}",
+        'Accept': 'application/vnd.github+json'
+    }
 
-        metrics = get_repo_metrics(
-            library['name'],
-            library['github_owner'], 
-            library['github_repo'],
-            config['github_token']
-        )
+    # Conditional GETs: unchanged endpoints come back 304 (free quota-wise)
+    # and we reuse the body cached from the previous run
+    etag_cache = load_etag_cache()
 
-        if metrics:
-            all_metrics.append(metrics)
+    # One session for the whole run: keep-alive means each request reuses a
+    # pooled TCP+TLS connection instead of paying the handshake every time
+    connector = aiohttp.TCPConnector(limit=20)
+    async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+        all_metrics = await fetch_repo_metrics(session, config.libraries)
 
-    insert_metrics(all_metrics, config['snowflake'])
+        contributor_tasks = [
+            fetch_contributor_count(metrics, session, sem, etag_cache)
+            for metrics in all_metrics
+        ]
+        activity_tasks = [
+            fetch_commit_activity(metrics, session, sem, etag_cache)
+            for metrics in all_metrics
+        ]
+        try:
+            results = await asyncio.gather(*contributor_tasks, *activity_tasks)
+        except RateLimitError as e:
+            # One task exhausting the quota means they all would; bail out
+            # with whatever partial work Snowflake already has
+            print(f"Aborting GitHub fetches: {e}")
+            raise
+        finally:
+            save_etag_cache(etag_cache)
+
+    weekly_rows = [
+        row
+        for activity in results[len(contributor_tasks):]
+        for row in activity
+    ]
+
+    try:
+        insert_metrics(all_metrics, conn)
+        insert_commit_activity(weekly_rows, conn)
+    finally:
+        if owns_conn:
+            conn.close()
 
     print('ETL for Github Complete!')
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
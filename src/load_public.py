@@ -1,78 +1,36 @@
 import snowflake.connector
-import os
-import json
-from dotenv import load_dotenv
 
-def load_config():
-    """Load configuration from config.json file and environment variables"""
-    # Load environment variables
-    load_dotenv()
-    
-    # Load libraries from config file
-    try:
-        with open('config.json', 'r') as f:
-            config_data = json.load(f)
-    except FileNotFoundError:
-        print("Error: config.json not found")
-        exit(1)
-    
-    # Get credentials from environment variables
-    config = {
-        "snowflake": {
-            "user": os.getenv('SNOWFLAKE_USER'),
-            "password": os.getenv('SNOWFLAKE_PASSWORD'),
-            "account": os.getenv('SNOWFLAKE_ACCOUNT'),
-            "warehouse": os.getenv('SNOWFLAKE_WAREHOUSE'),
-            "database": os.getenv('SNOWFLAKE_DATABASE'),
-            "schema": os.getenv('SNOWFLAKE_SCHEMA')
-        }
-    }
-    
-    # Validate required environment variables    
-    if not all(config['snowflake'].values()):
-        print("Error: Missing Snowflake environment variables. Required:")
-        print("SNOWFLAKE_USER, SNOWFLAKE_PASSWORD, SNOWFLAKE_ACCOUNT, SNOWFLAKE_WAREHOUSE, SNOWFLAKE_DATABASE, SNOWFLAKE_SCHEMA")
-        exit(1)
-    
-    return config
+from config import load_config
 
-def load_to_snowflake(snowflake_config):
+def load_to_snowflake(conn):
 
-    conn = snowflake.connector.connect(**snowflake_config)
     cursor = conn.cursor()
 
     try:
-        cursor.execute("TRUNCATE TABLE public.tech_metrics")
-
+        # CREATE OR REPLACE swaps the table atomically, so there's no
+        # TRUNCATE-then-INSERT window and no rollback handling needed --
+        # Snowflake keeps the old table until the new one commits.
+        # COPY GRANTS carries the consumer roles' SELECT privileges over
+        # to the replacement table
         sql = """
-        INSERT INTO public.tech_metrics (
-            name, github_owner, github_repository_name, pypi_name, language, 
-            stars, forks, watchers, open_issues, size_kb,
-            created_at, updated_at, total_contributors, total_commits,
-            total_downloads_alltime, commits_last_year, downloads_last_year,
-            commits_last_month, downloads_last_month
-        )
+        CREATE OR REPLACE TABLE public.tech_metrics COPY GRANTS AS
 
+        -- QUALIFY picks the latest row per name in a single scan, rather
+        -- than the GROUP BY + join-back pattern which scans each table twice
         WITH latest_github AS (
-            SELECT gm.*
-            FROM github_repo_metrics gm
-            INNER JOIN (
-                SELECT name, MAX(collected_at) AS max_collected_at
-                FROM github_repo_metrics
-                GROUP BY name
-            ) latest
-            ON gm.name = latest.name AND gm.collected_at = latest.max_collected_at
+            SELECT *
+            FROM github_repo_metrics
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY name ORDER BY collected_at DESC) = 1
         ),
+        -- collected_at is the right "latest" selector: downloads_last_year
+        -- can shrink as old days fall out of the rolling window, so the
+        -- old MAX(downloads_last_year) tiebreak could pick a stale row
+        -- NULLS LAST: rows from before the collected_at migration carry
+        -- NULL, which Snowflake would otherwise sort first in DESC order
         latest_pypi AS (
-            SELECT ps.*
-            FROM pypi_download_stats ps
-            INNER JOIN (
-                SELECT name, MAX(downloads_last_year) AS max_downloads_last_year
-                FROM pypi_download_stats
-                GROUP BY name
-            ) latest
-            ON ps.name = latest.name 
-               AND ps.downloads_last_year = latest.max_downloads_last_year
+            SELECT *
+            FROM pypi_download_stats
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY name ORDER BY collected_at DESC NULLS LAST) = 1
         )
         SELECT
             g.name,
@@ -94,7 +52,7 @@ def load_to_snowflake(snowflake_config):
             p.downloads_last_year,
             g.commits_last_month, 
             p.downloads_last_month
-        FROM latest_github g 
+        FROM latest_github g
         LEFT JOIN latest_pypi p ON g.name = p.name
         ORDER BY g.name;
 
@@ -102,29 +60,33 @@ def load_to_snowflake(snowflake_config):
 
         # Execute the combined query
         cursor.execute(sql)
-        inserted_count = cursor.rowcount
-        
-        # Commit the transaction
-        conn.commit()
-        
-        print(f"Successfully inserted {inserted_count} records into public.tech_metrics")
-    
+
+        print("Successfully rebuilt public.tech_metrics")
+
     except Exception as e:
         print(f"Error in loading data mart: {str(e)}")
-        print("Rolling back...")
-        conn.rollback()
-        print("Rollback complete")
+        print("Previous tech_metrics table is left untouched")
         raise
     finally:
         cursor.close()
-        conn.close()
 
 
-def main():
-    # Load configuration
-    config = load_config()
-    
-    load_to_snowflake(config['snowflake'])
+def main(conn=None, config=None):
+    # The orchestrator passes the parsed config in; standalone runs load it
+    if config is None:
+        config = load_config()
+
+    # The orchestrator passes in a shared connection so the Snowflake
+    # handshake isn't paid once per phase; standalone runs open their own
+    owns_conn = conn is None
+    if owns_conn:
+        conn = snowflake.connector.connect(**config.snowflake)
+
+    try:
+        load_to_snowflake(conn)
+    finally:
+        if owns_conn:
+            conn.close()
 
     print('Data mart succesfully loaded!')
 
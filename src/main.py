@@ -4,18 +4,23 @@ Runs both GitHub and PyPI ETL processes in sequence
 """
 
 import sys
+import asyncio
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging
 
+import snowflake.connector
+
 # Import the ETL modules
 try:
     import github_repo_etl
     import pypi_etl
     import load_public
+    from config import load_config, ConfigError
 except ImportError as e:
     print(f"Error importing ETL modules: {e}")
-    print("Make sure github_repo_etl.py, pypi_etl.py, and load_public.py are in the same directory")
+    print("Make sure github_repo_etl.py, pypi_etl.py, load_public.py, and config.py are in the same directory")
     sys.exit(1)
 
 def setup_logging():
@@ -30,11 +35,11 @@ def setup_logging():
     )
     return logging.getLogger(__name__)
 
-def run_github_etl(logger):
+def run_github_etl(logger, conn, config):
     """Run the GitHub repository ETL process"""
     logger.info("Starting GitHub ETL process...")
     try:
-        github_repo_etl.main()
+        asyncio.run(github_repo_etl.main(conn, config))
         logger.info("GitHub ETL completed successfully")
         return True
     except Exception as e:
@@ -42,11 +47,11 @@ def run_github_etl(logger):
         logger.error(traceback.format_exc())
         return False
 
-def run_pypi_etl(logger):
+def run_pypi_etl(logger, conn, config):
     """Run the PyPI download statistics ETL process"""
     logger.info("Starting PyPI ETL process...")
     try:
-        pypi_etl.main()
+        pypi_etl.main(conn, config)
         logger.info("PyPI ETL completed successfully")
         return True
     except Exception as e:
@@ -54,11 +59,11 @@ def run_pypi_etl(logger):
         logger.error(traceback.format_exc())
         return False
 
-def run_load_public(logger):
+def run_load_public(logger, conn, config):
     """Run the metrics combination ETL process"""
     logger.info("Starting metrics combination ETL process...")
     try:
-        load_public.main()
+        load_public.main(conn, config)
         logger.info("Metrics combination ETL completed successfully")
         return True
     except Exception as e:
@@ -82,24 +87,40 @@ def main():
         'pypi_success': False,
         'combine_success': False
     }
-    
-    # Run GitHub ETL
-    logger.info("\n" + "="*40)
-    logger.info("PHASE 1: GitHub Repository Metrics")
-    logger.info("="*40)
-    results['github_success'] = run_github_etl(logger)
-    
-    # Run PyPI ETL
-    logger.info("\n" + "="*40)
-    logger.info("PHASE 2: PyPI Download Statistics")
-    logger.info("="*40)
-    results['pypi_success'] = run_pypi_etl(logger)
-    
-    # Run Load Public
-    logger.info("\n" + "="*40)
-    logger.info("PHASE 3: Combining Metrics into Public Table")
-    logger.info("="*40)
-    results['combine_success'] = run_load_public(logger)
+
+    # Parse config.json and the environment once for the whole run.
+    # ConfigError is an ordinary exception, so a bad config gets logged
+    # properly instead of exit(1) killing the process from inside a helper
+    try:
+        config = load_config()
+    except ConfigError as e:
+        logger.error(f"Configuration error: {e}")
+        sys.exit(1)
+
+    # One Snowflake connection shared across all phases; the handshake and
+    # auth exchange cost seconds, so don't pay them three times
+    conn = snowflake.connector.connect(**config.snowflake)
+
+    try:
+        # Phases 1 and 2 are independent (different sources, different
+        # staging tables) so they run in parallel; Snowflake connections
+        # are safe to share across threads. Phase 3 joins on both.
+        logger.info("\n" + "="*40)
+        logger.info("PHASES 1+2: GitHub Repository Metrics / PyPI Download Statistics (parallel)")
+        logger.info("="*40)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            github_future = executor.submit(run_github_etl, logger, conn, config)
+            pypi_future = executor.submit(run_pypi_etl, logger, conn, config)
+            results['github_success'] = github_future.result()
+            results['pypi_success'] = pypi_future.result()
+
+        # Run Load Public
+        logger.info("\n" + "="*40)
+        logger.info("PHASE 3: Combining Metrics into Public Table")
+        logger.info("="*40)
+        results['combine_success'] = run_load_public(logger, conn, config)
+    finally:
+        conn.close()
     
     # Summary
     end_time = datetime.now()